@@ -1,68 +1,50 @@
 # Graph Drawing by Stochastic Gradient Descent
 # https://arxiv.org/abs/1710.04626
 
-from collections import deque
-import random
 import math
 import time
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from datetime import datetime
 import sys
 from scipy.io import mmread
 import scipy.sparse as sp
+import scipy.sparse.csgraph as csg
+from numba import njit, prange, float32, cuda
 
 def calc_adj_matrix(H):
-  n = H.number_of_nodes()
-  adj = [[] for _ in range(n)]
-  for edge in H.edges():
-    adj[edge[0]].append(edge[1])
-    adj[edge[1]].append(edge[0])
-  return adj
+  # NOTE: 隣接リストではなく CSR 行列として取り出す
+  # v の隣接頂点は A.indices[A.indptr[v]:A.indptr[v+1]]
+  return nx.to_scipy_sparse_array(H,format='csr',dtype=np.int8)
 
 def calc_dist_matrix(H):
-  adj = calc_adj_matrix(H)
-  n = len(adj)
-  dist_matrix = {}
-  for i in range(n):
-    deq = deque()
-    seen = [False] * n
-    d = {}
-    deq.append(i)
-    seen[i] = True
-    d[i] = 0
-    while deq:
-      v = deq.popleft()
-      for u in adj[v]:
-        if seen[u]:
-          continue
-        deq.append(u)
-        seen[u] = True
-        d[u] = d[v] + 1
-    dist_matrix[i] = d
-  return dist_matrix
-
-def calc_edge_info(H, dist):
-  nodes = list(H.nodes())
-  pairs = []
-  dmin = math.inf
-  dmax = 0.0
-  for u in dist:
-    for v in dist[u]:
-      if u>=v:
-        continue
-      dij = float(dist[u][v])
-      if dij<=0:
-        continue
-      wij = 1.0/(dij*dij)
-      pairs.append((u,v,dij,wij))
-      dmin = min(dmin,dij)
-      dmax = max(dmax,dij)
-      
+  # NOTE: 距離行列は (n,n) の int16 で保持する(到達不能は -1)
+  A = calc_adj_matrix(H)
+  D = csg.shortest_path(A,method='D',unweighted=True,directed=False)
+  D[~np.isfinite(D)] = -1
+  return D.astype(np.int16)
+
+def calc_edge_info(H, dist, nodes=None):
+  if nodes is None:
+    nodes = list(H.nodes())
+  n = len(nodes)
+  # NOTE: ペアは (i,j,dij,wij) のタプルではなく配列ごとに保持する(SoA)
+  # 上三角のうち到達可能なペアのみを取り出す
+  iu0,iu1 = np.triu_indices(n,1)
+  d = dist[iu0,iu1]
+  mask = d>0
+  I = iu0[mask].astype(np.int32)
+  J = iu1[mask].astype(np.int32)
+  # NOTE: 描画座標に倍精度は不要なので float32 で保持する
+  Dij = d[mask].astype(np.float32)
+  Wij = np.float32(1.0)/(Dij*Dij)
+  dmin = float(Dij.min())
+  dmax = float(Dij.max())
   wmin = 1.0/(dmax*dmax)
   wmax = 1.0/(dmin*dmin)
-  return pairs,wmin,wmax,nodes
+  return I,J,Dij,Wij,wmin,wmax,nodes
   
 def calc_learning_rate(tmax,wmin,wmax,eps=0.1):
   # NOTE: 学習率の境界について
@@ -74,63 +56,248 @@ def calc_learning_rate(tmax,wmin,wmax,eps=0.1):
   etas = [eta_max*math.exp(-lamb*t) for t in range(tmax)]
   return etas
 
-def calc_dist(diff):
-  return math.sqrt(diff[0]**2 + diff[1]**2)
+@njit(cache=True)
+def _color_pairs(I,J,n):
+  # NOTE: ペアグラフの貪欲辺彩色
+  # 同じ色のペアは頂点を共有しないので、色ごとに並列に更新できる
+  # 使用済みの色は頂点ごとのビット集合で持ち、実際に到達した色数に合わせて拡張する
+  words = 1
+  used = np.zeros((n,words),dtype=np.uint64)
+  full = ~np.uint64(0)
+  one = np.uint64(1)
+  color = np.empty(I.shape[0],dtype=np.int32)
+  num_colors = 0
+  for k in range(I.shape[0]):
+    i = I[k]
+    j = J[k]
+    w = 0
+    while w<words and (used[i,w]|used[j,w])==full:
+      w += 1
+    if w==words:
+      grown = np.zeros((n,2*words),dtype=np.uint64)
+      grown[:,:words] = used
+      used = grown
+      words *= 2
+    free = ~(used[i,w]|used[j,w])
+    b = 0
+    while (free>>np.uint64(b))&one==0:
+      b += 1
+    used[i,w] |= one<<np.uint64(b)
+    used[j,w] |= one<<np.uint64(b)
+    c = 64*w+b
+    color[k] = c
+    num_colors = max(num_colors,c+1)
+  return color,num_colors
+
+def calc_pair_coloring(I,J,Dij,Wij,n):
+  color,num_colors = _color_pairs(I,J,n)
+  order = np.argsort(color,kind='stable')
+  color = color[order]
+  color_starts = np.zeros(num_colors+1,dtype=np.int64)
+  color_starts[1:] = np.cumsum(np.bincount(color,minlength=num_colors))
+  return I[order],J[order],Dij[order],Wij[order],color,color_starts
+
+@njit(cache=True,parallel=True)
+def _shuffle_blocks(perm,starts,U):
+  # NOTE: 色ごとの区間 [starts[c],starts[c+1]) 内だけを Fisher-Yates でシャッフルする
+  # 乱数 U はホスト側の rng から渡すので、seed で結果が再現できる
+  for c in prange(starts.shape[0]-1):
+    start = starts[c]
+    for k in range(starts[c+1]-1,start,-1):
+      r = start+min(int(U[k]*(k-start+1)),k-start)
+      tmp = perm[k]
+      perm[k] = perm[r]
+      perm[r] = tmp
 
-def sgd(H,dim=2,iterations=15,epsilon=0.1,seed=0,center=True):
+@njit(fastmath=True,cache=True,boundscheck=False,parallel=True,
+      locals={'dij':float32,'xi0':float32,'xi1':float32,'xj0':float32,'xj1':float32,
+              'dx':float32,'dy':float32,'norm2':float32,'dij2':float32,'norm':float32,'mu':float32,'s':float32})
+def _sgd_epoch(I,J,Dij,Mu,X,Nudge,perm,color_starts,color_order):
+  tiny = 1e-12
+  for c in color_order:
+    for k in prange(color_starts[c],color_starts[c+1]):
+      idx = perm[k]
+      i = I[idx]
+      j = J[idx]
+      dij = Dij[idx]
+      xi0 = X[i,0]
+      xi1 = X[i,1]
+      xj0 = X[j,0]
+      xj1 = X[j,1]
+      dx = xj0-xi0
+      dy = xj1-xi1
+      # NOTE: 距離がほぼ dij に一致するペアは更新量がほぼ0なので、sqrt の前に二乗のまま判定して飛ばす
+      norm2 = dx*dx+dy*dy
+      dij2 = dij*dij
+      if norm2>dij2*0.9999 and norm2<dij2*1.0001:
+        continue
+      norm = math.sqrt(norm2)
+      if norm<tiny:
+        # NOTE: 重なったペアはホスト側の rng で引いた微小な方向にずらす
+        dx = Nudge[i,0]
+        dy = Nudge[i,1]
+        norm = math.sqrt(dx*dx+dy*dy)
+        
+      # NOTE: i から 勾配方向に ずれ*学習率*(1/2) ずつ移動
+      mu = Mu[idx]
+      s = mu*(norm-dij)/(2.0*norm)
+      X[i,0] += s*dx
+      X[i,1] += s*dy
+      X[j,0] -= s*dx
+      X[j,1] -= s*dy
+
+@cuda.jit(fastmath=True)
+def _sgd_kernel(I,J,Dij,Mu,X,Nudge,perm,start,end):
+  k = start+cuda.grid(1)
+  if k>=end:
+    return
+  idx = perm[k]
+  i = I[idx]
+  j = J[idx]
+  dij = Dij[idx]
+  dx = X[j,0]-X[i,0]
+  dy = X[j,1]-X[i,1]
+  norm2 = dx*dx+dy*dy
+  dij2 = dij*dij
+  if norm2>dij2*np.float32(0.9999) and norm2<dij2*np.float32(1.0001):
+    return
+  if norm2<np.float32(1e-24):
+    # NOTE: 重なったペアはホスト側の rng で引いた微小な方向にずらす
+    dx = Nudge[i,0]
+    dy = Nudge[i,1]
+    norm2 = dx*dx+dy*dy
+  norm = math.sqrt(norm2)
+  mu = Mu[idx]
+  s = mu*(norm-dij)/(np.float32(2.0)*norm)
+  X[i,0] += s*dx
+  X[i,1] += s*dy
+  X[j,0] -= s*dx
+  X[j,1] -= s*dy
+
+@cuda.jit(fastmath=True)
+def _step_kernel(Wij,Mu,perm,eta):
+  k = cuda.grid(1)
+  if k>=perm.shape[0]:
+    return
+  idx = perm[k]
+  Mu[idx] = min(Wij[idx]*eta,np.float32(1.0))
+
+CUDA_THREADS_PER_BLOCK = 256
+
+def _sgd_epoch_cuda(I,J,Dij,Wij,Mu,X,Nudge,eta,perm,color_starts,color_order):
+  # NOTE: グリッドが 0 ブロックのカーネル起動は CUDA ではエラーになるので、空のときは起動しない
+  if perm.shape[0]==0:
+    return
+  # NOTE: μ はデバイス上で、このエポックで使うペアの分だけ計算する
+  blocks = (perm.shape[0]+CUDA_THREADS_PER_BLOCK-1)//CUDA_THREADS_PER_BLOCK
+  _step_kernel[blocks,CUDA_THREADS_PER_BLOCK](Wij,Mu,perm,np.float32(eta))
+  # NOTE: 同じ色のペアは頂点を共有しないので、色ごとに1回カーネルを起動する
+  for c in color_order:
+    start = color_starts[c]
+    end = color_starts[c+1]
+    # NOTE: 抽出時は1つもペアが選ばれない色があり得る
+    if end==start:
+      continue
+    blocks = (end-start+CUDA_THREADS_PER_BLOCK-1)//CUDA_THREADS_PER_BLOCK
+    _sgd_kernel[blocks,CUDA_THREADS_PER_BLOCK](I,J,Dij,Mu,X,Nudge,perm,start,end)
+
+def sgd(H,dim=2,iterations=15,epsilon=0.1,seed=0,center=True,nodes=None,use_cuda=False,pairs_per_node=None):
+  # NOTE: カーネルは x,y をスカラーとして扱う 2 次元専用の実装
+  if dim!=2:
+    raise ValueError("sgd only supports dim=2")
+  if pairs_per_node is not None and pairs_per_node<=0:
+    raise ValueError("pairs_per_node must be positive")
+  if use_cuda and not cuda.is_available():
+    raise RuntimeError("CUDA is not available")
+  
   rng = np.random.RandomState(seed)
   
   # NOTE: 前処理
   dist = calc_dist_matrix(H)
-  pairs,wmin,wmax,nodes = calc_edge_info(H,dist)
+  I,J,Dij,Wij,wmin,wmax,nodes = calc_edge_info(H,dist,nodes)
   etas = calc_learning_rate(iterations,wmin,wmax,eps=epsilon)
+  n = len(nodes)
+  I,J,Dij,Wij,color,color_starts = calc_pair_coloring(I,J,Dij,Wij,n)
+  num_colors = len(color_starts)-1
   
   # NOTE: 初期配置を計算と保存
-  n = len(nodes)
-  X = rng.rand(n,dim)
+  X = rng.rand(n,dim).astype(np.float32)
   if center:
     X -= X.mean(axis=0,keepdims=True)
   pos_init = {nodes[i]:X[i].copy() for i in range(n)}
   
   # NOTE: SGDを実行
-  tiny = 1e-12
+  # pairs_per_node を指定すると、各エポックで全ペアではなく約 pairs_per_node*n 個のペアを一様に抽出して更新する
+  # 1エポックが O(n^2) から O(n) になる代わりに、各エポックで一部の制約しか更新されないため収束は遅くなる
+  m = len(Dij)
+  # NOTE: 抽出数が全ペア数以上なら、重複ありの抽出は全ペアの約 63% しか更新しないので全ペアを使う
+  sampled = pairs_per_node is not None and pairs_per_node*n<m
+  if not sampled:
+    # NOTE: 配列は色順に並んでいるので、全ペアを使う場合は前エポックの並びを色の区間ごとにシャッフルし直す
+    perm = np.arange(m,dtype=np.int32)
+    epoch_starts = color_starts
+  if use_cuda:
+    # NOTE: ペア情報と座標はデバイスに一度だけ転送し、最後に座標だけ戻す
+    d_I,d_J,d_Dij,d_Wij,d_X = (cuda.to_device(a) for a in (I,J,Dij,Wij,X))
+    d_Mu = cuda.device_array(m,dtype=np.float32)
+  else:
+    Mu = np.empty(m,dtype=np.float32)
   for iteration, eta in enumerate(etas):
-    random.shuffle(pairs)
-    for i,j,dij,wij in pairs:
-      diff = X[j]-X[i]
-      norm = calc_dist(diff)
-      if norm<tiny:
-        diff = rng.normal(scale=1e-6,size=dim)
-        norm = calc_dist(diff)
-        
-      # NOTE: i から 勾配方向に ずれ*学習率*(1/2) ずつ移動
-      r = ((norm-dij)/2.0)*(diff/norm)
-      mu = min(wij*eta,1.0)
-      X[i] += mu*r
-      X[j] -= mu*r
-      
+    if sampled:
+      # NOTE: 重複したペアが同じ色に入ると並列更新が衝突するので np.unique で取り除く
+      # np.unique の結果は昇順なので、そのまま色ごとにまとまっている
+      perm = np.unique(rng.randint(0,m,size=pairs_per_node*n)).astype(np.int32)
+      epoch_starts = np.searchsorted(color[perm],np.arange(num_colors+1))
+    # NOTE: 色ごとの区間内でシャッフルし、色の処理順もシャッフルする
+    _shuffle_blocks(perm,epoch_starts,rng.rand(len(perm)))
+    color_order = rng.permutation(num_colors)
+    # NOTE: 重なったペアをずらす方向は頂点ごとにエポック単位で引いておき、seed で再現できるようにする
+    # 同じ色のペアは頂点を共有しないので、並列に更新しても同じ値を取り合うことはない
+    Nudge = rng.normal(scale=1e-6,size=(n,dim)).astype(np.float32)
+    if use_cuda:
+      # NOTE: 毎エポック転送するのは perm と Nudge だけ(抽出時は O(n))
+      _sgd_epoch_cuda(d_I,d_J,d_Dij,d_Wij,d_Mu,d_X,cuda.to_device(Nudge),eta,cuda.to_device(perm),epoch_starts,color_order)
+    else:
+      # NOTE: 学習率 μ = min(wij*η,1) はエポック内で不変なので先にまとめて計算する
+      if not sampled:
+        np.minimum(Wij*np.float32(eta),np.float32(1.0),out=Mu)
+      else:
+        Mu[perm] = np.minimum(Wij[perm]*np.float32(eta),np.float32(1.0))
+      _sgd_epoch(I,J,Dij,Mu,X,Nudge,perm,epoch_starts,color_order)
     print("Iteration: ", iteration+1)
+  if use_cuda:
+    d_X.copy_to_host(X)
       
   if center:
     X -= X.mean(axis=0,keepdims=True)
           
   pos_final = {nodes[i]: X[i].copy() for i in range(n)}
-  return pos_init, pos_final
+  # NOTE: 距離行列も返して、ストレス計算で再計算しないようにする
+  return pos_init, pos_final, dist
 
-def calc_stress(H, pos):
-  dist = calc_dist_matrix(H)
-  nodes = list(H.nodes())
+def calc_stress(H, pos, dist=None, nodes=None):
+  if dist is None:
+    dist = calc_dist_matrix(H)
+  if nodes is None:
+    nodes = list(H.nodes())
+  n = len(nodes)
   X = np.array([pos[u] for u in nodes], dtype=float)
-  val = 0.0
-  for u in dist:
-    for v in dist[u]:
-      if u>=v:
-        continue
-      dij = float(dist[u][v])
-      wij = 1.0/(dij*dij)
-      # NOTE: 1/2にすることで、勾配の計算が楽になる
-      val += (1/2.0) * wij * (calc_dist(X[u]-X[v]) - dij)**2
-  return val
+  iu0,iu1 = np.triu_indices(n,1)
+  diff = X[iu0]-X[iu1]
+  euc = np.sqrt(np.einsum('ij,ij->i',diff,diff))
+  d = dist[iu0,iu1]
+  mask = d>0
+  dij = d[mask].astype(float)
+  wij = 1.0/(dij*dij)
+  # NOTE: 1/2にすることで、勾配の計算が楽になる
+  return (1/2.0) * np.sum(wij * (euc[mask]-dij)**2)
+
+def draw_layout(ax, edges, X, node_size=30, width=0.8):
+  # NOTE: nx.draw は辺ごとに artist を作るので、LineCollection で一括描画する
+  segs = np.stack([X[edges[:,0]],X[edges[:,1]]],axis=1)
+  ax.add_collection(LineCollection(segs,linewidths=width,colors='k'))
+  ax.scatter(X[:,0],X[:,1],s=node_size,c='#1f78b4',zorder=2)
+  ax.set_axis_off()
 
 def load_graph_from_mtx(mtx_path):
   """Load graph from Matrix Market file"""
@@ -178,18 +345,25 @@ if __name__ == "__main__":
   
   print(f"Graph: {H.number_of_nodes()} nodes, {H.number_of_edges()} edges")
   
+  nodes = list(H.nodes())
+  
   sgd_start = time.perf_counter()
-  pos0, pos1 = sgd(H,iterations=15,epsilon=0.1,seed=0)
+  pos0, pos1, dist = sgd(H,iterations=15,epsilon=0.1,seed=0,nodes=nodes)
 
   sgd_end = time.perf_counter()
   print(f"Time taken: {sgd_end-sgd_start}s")
   
-  s0 = calc_stress(H,pos0)
-  s1 = calc_stress(H,pos1)
+  s0 = calc_stress(H,pos0,dist,nodes)
+  s1 = calc_stress(H,pos1,dist,nodes)
   
   print(f"stress (init) = {s0:.3f}")
   print(f"stress (after) = {s1:.3f}")
   
+  # NOTE: 書き込みは行ごとではなく np.savetxt でまとめて行う
+  edges_arr = np.asarray(list(H.edges()), dtype=np.int64).reshape(-1, 2)
+  pos0_arr = np.asarray([pos0[k] for k in nodes])
+  pos1_arr = np.asarray([pos1[k] for k in nodes])
+  
   # Save initial positions (after randomization) to file with timestamp
   timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
   filename_init = f'output/python-sgd-{graph_name}-{timestamp}-0.txt'
@@ -201,13 +375,13 @@ if __name__ == "__main__":
     f.write(f"# Edge count: {H.number_of_edges()}\n")
     f.write("\n")
     f.write("# Edges (source target)\n")
-    for edge in H.edges():
-      f.write(f"{edge[0]} {edge[1]}\n")
+    np.savetxt(f, edges_arr, fmt='%d %d')
     f.write("\n")
     f.write("# Positions (x y)\n")
-    for node in sorted(pos0.keys()):
-      x, y = pos0[node]
-      f.write(f"{x} {y}\n")
+    np.savetxt(f, pos0_arr, fmt='%.9g %.9g')
+  
+  # NOTE: 座標はテキストに加えて .npy でも保存する(visualize_result.py はこちらを優先して読む)
+  np.save(f'output/python-sgd-{graph_name}-{timestamp}-0.npy', pos0_arr)
   
   print(f"Initial result saved to {filename_init}")
   
@@ -221,23 +395,22 @@ if __name__ == "__main__":
     f.write(f"# Edge count: {H.number_of_edges()}\n")
     f.write("\n")
     f.write("# Edges (source target)\n")
-    for edge in H.edges():
-      f.write(f"{edge[0]} {edge[1]}\n")
+    np.savetxt(f, edges_arr, fmt='%d %d')
     f.write("\n")
     f.write("# Positions (x y)\n")
-    for node in sorted(pos1.keys()):
-      x, y = pos1[node]
-      f.write(f"{x} {y}\n")
+    np.savetxt(f, pos1_arr, fmt='%.9g %.9g')
+  
+  np.save(f'output/python-sgd-{graph_name}-{timestamp}-1.npy', pos1_arr)
   
   print(f"Processed result saved to {filename_processed}")
 
   fig, axes = plt.subplots(1, 2, figsize=(30,10))
   axes[0].set_title(f"Initial (stress={s0:.2f})")
-  nx.draw(H, pos0, ax=axes[0], node_size=30, width=0.8, with_labels=False)
+  draw_layout(axes[0], edges_arr, pos0_arr, node_size=30, width=0.8)
   axes[0].axis("equal")
 
   axes[1].set_title(f"After SGD (stress={s1:.2f})")
-  nx.draw(H, pos1, ax=axes[1], node_size=30, width=0.8, with_labels=False)
+  draw_layout(axes[1], edges_arr, pos1_arr, node_size=30, width=0.8)
   axes[1].axis("equal")
 
   plt.tight_layout()
@@ -7,14 +7,16 @@ import sys
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from pathlib import Path
 
 def read_result_file(filepath):
-    """Read vram-lock result file"""
+    """Read vram-lock result file (positions are taken from a sibling .npy if present)"""
     edges = []
     positions = []
     node_count = 0
     edge_count = 0
+    npy_path = Path(filepath).with_suffix('.npy')
     
     with open(filepath, 'r') as f:
         mode = None
@@ -34,6 +36,8 @@ def read_result_file(filepath):
                 mode = 'edges'
                 continue
             elif line.startswith('# Positions'):
+                if npy_path.exists():
+                    break
                 mode = 'positions'
                 continue
             elif line.startswith('#'):
@@ -49,27 +53,25 @@ def read_result_file(filepath):
                 if len(parts) == 2:
                     positions.append([float(parts[0]), float(parts[1])])
     
+    if npy_path.exists():
+        return node_count, edges, np.load(npy_path).astype(float)
     return node_count, edges, np.array(positions)
 
 def calc_stress(G, pos):
     """Calculate stress (same as sgd_stress_nongpu.py)"""
     import scipy.sparse.csgraph as csg
     n = len(pos)
-    A = nx.adjacency_matrix(G).todense()
-    D = csg.shortest_path(A, method='FW', directed=False)
-    
-    stress = 0.0
-    for i in range(n):
-        for j in range(i+1, n):
-            dij = D[i,j]
-            if dij == 0 or np.isinf(dij):
-                continue
-            xi, yi = pos[i]
-            xj, yj = pos[j]
-            euc = np.sqrt((xi-xj)**2 + (yi-yj)**2)
-            wij = 1.0 / (dij * dij)
-            stress += wij * (euc - dij)**2
-    return stress
+    A = nx.to_scipy_sparse_array(G, format='csr', dtype=np.int8)
+    D = csg.shortest_path(A, method='D', unweighted=True, directed=False)
+    
+    iu0, iu1 = np.triu_indices(n, 1)
+    diff = pos[iu0] - pos[iu1]
+    euc = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    d = D[iu0, iu1]
+    mask = (d > 0) & np.isfinite(d)
+    dij = d[mask]
+    wij = 1.0 / (dij * dij)
+    return np.sum(wij * (euc[mask] - dij)**2)
 
 def visualize(filepath, output_image=None):
     """Visualize result and calculate stress"""
@@ -84,17 +86,19 @@ def visualize(filepath, output_image=None):
     G.add_nodes_from(range(node_count))
     G.add_edges_from(edges)
     
-    # Create position dict
-    pos_dict = {i: positions[i] for i in range(len(positions))}
-    
     # Calculate stress
     stress = calc_stress(G, positions)
     print(f"Stress: {stress:.3f}")
     
     # Visualize
     plt.figure(figsize=(12, 10))
-    plt.title(f"vram-lock Result (stress={stress:.2f})")
-    nx.draw(G, pos_dict, node_size=5, width=0.5, with_labels=False)
+    ax = plt.gca()
+    ax.set_title(f"vram-lock Result (stress={stress:.2f})")
+    edges_arr = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    segs = np.stack([positions[edges_arr[:, 0]], positions[edges_arr[:, 1]]], axis=1)
+    ax.add_collection(LineCollection(segs, linewidths=0.5, colors='k'))
+    ax.scatter(positions[:, 0], positions[:, 1], s=5, c='#1f78b4', zorder=2)
+    ax.set_axis_off()
     plt.axis("equal")
     
     if output_image: